@@ -1,52 +1,127 @@
 import os
 import sys
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
-from datetime import datetime
+from itertools import chain
+from operator import itemgetter
+from functools import lru_cache
+from types import SimpleNamespace
+import ijson
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+import ciso8601
+from datetime import date, datetime
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.model import JsonModel
 from dotenv import load_dotenv
 
-# Load environment variables from .env file
-load_dotenv()
+# Sheet tabs to export and the environment variable holding the ID of the assistant
+# whose calls go into each of them
+JOBS = [
+    ("pepfactor_outbound", 'ASSISTANT_ID'),
+    ("pepfactor_inbound", 'INBOUND_ASSISTANT_ID'),
+    ("greycorp_outbound", 'GREYCORP_OUT_ASSISTANT_ID'),
+    ("greycorp_inbound", 'GREYCORP_IN_ASSISTANT_ID'),
+]
 
-# Environment variables
-VAPI_URL = os.getenv('VAPI_URL')
-PEPFACTOR_OUT_ASSISTANT_ID = os.getenv('ASSISTANT_ID')
-PEPFACTOR_IN_ASSISTANT_ID = os.getenv('INBOUND_ASSISTANT_ID')
-GREYCORP_OUT_ASSISTANT_ID = os.getenv('GREYCORP_OUT_ASSISTANT_ID')
-GREYCORP_IN_ASSISTANT_ID = os.getenv('GREYCORP_IN_ASSISTANT_ID')
-BEARER_TOKEN = os.getenv('BEARER_TOKEN')
-SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
-SERVICE_ACCOUNT_FILE = os.getenv('SERVICE_ACCOUNT_FILE')
+# Environment variables that must be set for the export to run
+REQUIRED_ENV_VARS = ('VAPI_URL', 'BEARER_TOKEN', 'SPREADSHEET_ID', 'SERVICE_ACCOUNT_FILE')
+
+# Function to load the configuration from the environment
+# Loaded lazily and cached, so the .env file is only read once per process even when
+# main is called repeatedly (e.g. from a scheduler), and tests can patch config() directly
+@lru_cache(maxsize=1)
+def config():
+    # Load environment variables from .env file
+    load_dotenv()
+
+    missing = [name for name in REQUIRED_ENV_VARS if not os.getenv(name)]
+    if missing:
+        raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
+
+    return SimpleNamespace(
+        vapi_url=os.getenv('VAPI_URL'),
+        bearer_token=os.getenv('BEARER_TOKEN'),
+        spreadsheet_id=os.getenv('SPREADSHEET_ID'),
+        service_account_file=os.getenv('SERVICE_ACCOUNT_FILE'),
+        assistant_ids={sheet_name: os.getenv(env_var) for sheet_name, env_var in JOBS},
+    )
+
+# Fields of a call record that are needed for the export and pagination
+# Everything else (messages, costs, artifacts, ...) is dropped right after each call is parsed
+CALL_FIELDS = ('id', 'createdAt', 'startedAt', 'endedAt', 'transcript', 'customer', 'analysis')
+
+# Whether datetime.fromisoformat understands the 'Z' UTC suffix
+_PY311 = sys.version_info >= (3, 11)
+
+# Header row written at the top of every sheet
+# A tuple so it can be shared between sheets without being mutated (serialized as a JSON array)
+HEADER_ROW = ('ID', 'Phone Number', 'Duration (seconds)', 'Start Time', 'End Time', 'Summary', 'Success Evaluation', 'Transcript')
+
+# Shared read-only default for missing nested objects, so lookups on calls without
+# customer/analysis data don't allocate a new empty dict each time
+_EMPTY = {}
+_get_call_times = itemgetter('startedAt', 'endedAt')
 
 # Array of phone numbers to exclude
 EXCLUDE_PHONE_NUMBERS = ["+61430960262", "+16197647586", "+14587773760"]
 
+# Shared HTTP session so every paginated request reuses the same keep-alive connection
+# to the Vapi API instead of doing a new TCP + TLS handshake per page.
+# Transient errors and rate limiting are retried with a backoff
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+))
+
+# Function to fetch and parse a single page of call logs from the Vapi API
+def fetch_call_page(url, headers, params):
+    # Make a GET request to the API with a limit of 100 calls (the max allowed per request)
+    # The response is closed on every path so its pooled connection is released even when
+    # the request fails or the body can't be parsed
+    with SESSION.get(url, headers=headers, params=params, stream=True) as response:
+        response.raise_for_status()
+
+        # Parse the JSON response
+        # The body is streamed through ijson, so the full response text is never held in memory.
+        # ijson still builds each complete call (messages, artifacts, costs, ...), but only one
+        # at a time, and each one is trimmed to CALL_FIELDS before the next is parsed
+        response.raw.decode_content = True
+        return [
+            {field: call[field] for field in CALL_FIELDS if field in call}
+            for call in ijson.items(response.raw, 'item', use_float=True)
+        ]
+
 # Function to fetch call logs from the Vapi API
 # Instead of using page numbers, the Vapi API uses cursor-based pagination. 
 # We implement this by using the createdAtLt parameter and set it to the createdAt timestamp of the last
 # call in the current batch of requests
-def fetch_call_logs(url, assistant_id, bearer_token):
+# Pages are yielded one at a time so they can be filtered and discarded as they arrive
+# instead of holding every call record (and its transcript) in memory at once
+def iter_call_pages(url, assistant_id, bearer_token):
     headers = {
-        "Authorization": f"Bearer {bearer_token}"
+        "Authorization": f"Bearer {bearer_token}",
+        # Call logs are repetitive JSON with long transcripts and compress very well
+        # The streamed body is decompressed by response.raw (decode_content) before ijson reads it
+        "Accept-Encoding": "gzip, deflate"
     }
     params = {
         "assistantId": assistant_id,
         "limit": 100  # Maximum allowed per request
     }
-    all_calls = []
+    total_calls = 0
     
     while True:
-        # Make a GET request to the API with a limit of 100 calls (the max allowed per request)
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        
-        # Parse the JSON response
-        data = response.json()
+        data = fetch_call_page(url, headers, params)
 
-        # Add the fetched calls to our list
-        all_calls.extend(data)
+        # Hand the fetched calls to the caller
+        total_calls += len(data)
+        yield data
         
         # Check if we've reached the end of the available data
         # If we receive fewer calls than the limit, it means we're on the last page so we exit the loop
@@ -59,105 +134,183 @@ def fetch_call_logs(url, assistant_id, bearer_token):
         # as the starting point for the next request
         params["createdAtLt"] = data[-1]["createdAt"]
     
-    print(f"Total calls fetched: {len(all_calls)}")
-    return all_calls
+    print(f"Total calls fetched: {total_calls}")
+
+# Function to parse a call timestamp
+# ciso8601 parses the trailing 'Z' natively and is much faster than fromisoformat,
+# so we only fall back to fromisoformat for timestamps ciso8601 rejects.
+# Python 3.11+ accepts the 'Z' suffix in fromisoformat, older versions need it rewritten.
+# Cached since the same timestamps can show up repeatedly across calls and runs of main
+@lru_cache(maxsize=4096)
+def parse_timestamp(timestamp):
+    try:
+        return ciso8601.parse_datetime(timestamp)
+    except ValueError:
+        if _PY311:
+            return datetime.fromisoformat(timestamp)
+        return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
 
 # Function to calculate the duration of a call
 def calculate_duration(start_time, end_time):
-    start = datetime.fromisoformat(start_time.replace('Z', '+00:00'))
-    end = datetime.fromisoformat(end_time.replace('Z', '+00:00'))
-    duration = (end - start).total_seconds()
+    duration = (parse_timestamp(end_time) - parse_timestamp(start_time)).total_seconds()
+    return duration
+
+# Function to check the date part (YYYY-MM-DD) of a timestamp
+# Cached since all calls of a day share the same date prefix
+@lru_cache(maxsize=1024)
+def _is_valid_date(date_part):
+    if date_part[4] != '-' or date_part[7] != '-':
+        return False
+    try:
+        date.fromisoformat(date_part)
+    except ValueError:
+        return False
+    return True
+
+# Function to read the time of day of a canonical UTC ISO-8601 timestamp in milliseconds
+# Returns None if any separator or field is malformed or out of range
+def _time_of_day_ms(timestamp):
+    if timestamp[10] != 'T' or timestamp[13] != ':' or timestamp[16] != ':':
+        return None
+    fields = timestamp[11:13] + timestamp[14:16] + timestamp[17:19]
+    if len(timestamp) == 24:
+        if timestamp[19] != '.':
+            return None
+        fields += timestamp[20:23]
+    if not (fields.isascii() and fields.isdigit()):
+        return None
+    hours, minutes, seconds = int(fields[0:2]), int(fields[2:4]), int(fields[4:6])
+    if hours > 23 or minutes > 59 or seconds > 59:
+        return None
+    return (hours * 3600 + minutes * 60 + seconds) * 1000 + int(fields[6:] or 0)
+
+# Fast path for the common case where both timestamps are canonical UTC ISO-8601
+# strings from the same day (e.g. 2024-05-01T12:34:56.789Z), so the duration can be
+# read straight off the time fields without building any datetime objects.
+# Returns None when the strings don't match that shape (including invalid dates or
+# times) so the caller can fall back to calculate_duration, which reports the error
+def fast_duration(start_time, end_time):
+    length = len(start_time)
+    if (length not in (20, 24) or len(end_time) != length
+            or start_time[:10] != end_time[:10] or start_time[-1] != 'Z' or end_time[-1] != 'Z'
+            or not _is_valid_date(start_time[:10])):
+        return None
+    start_ms = _time_of_day_ms(start_time)
+    end_ms = _time_of_day_ms(end_time)
+    if start_ms is None or end_ms is None:
+        return None
+    return (end_ms - start_ms) / 1000
+
+# Function to get the duration of a call, or None if its timestamps can't be parsed
+def _call_duration(call):
+    started_at, ended_at = _get_call_times(call)
+    duration = fast_duration(started_at, ended_at)
+    if duration is None:
+        try:
+            duration = calculate_duration(started_at, ended_at)
+        except ValueError as e:
+            print(f"Error calculating duration for call {call['id']}: {str(e)}")
+            return None
     return duration
 
+# Function to build the exported row for a call
+def _call_row(call, phone_number, duration):
+    analysis = call.get('analysis', _EMPTY)
+    return [
+        call['id'],
+        phone_number,
+        duration,
+        call['startedAt'],
+        call['endedAt'],
+        analysis.get('summary', 'N/A'),
+        analysis.get('successEvaluation', 'N/A'),
+        call['transcript']
+    ]
+
 # Function to filter calls that last longer than a specified duration
+# The duration is checked first so short calls skip the remaining lookups
 def filter_calls(calls, min_duration=20):
-    filtered_calls = []
-    for call in calls:
-        if 'startedAt' in call and 'endedAt' in call:
-            try:
-                duration = calculate_duration(call['startedAt'], call['endedAt'])
-                phone_number = call.get('customer', {}).get('number', 'N/A')
-                if duration > min_duration and phone_number not in EXCLUDE_PHONE_NUMBERS:
-                    analysis = call.get('analysis', {})
-                    filtered_calls.append([
-                        call['id'],
-                        phone_number,
-                        duration,
-                        call['startedAt'],
-                        call['endedAt'],
-                        analysis.get('summary', 'N/A'),
-                        analysis.get('successEvaluation', 'N/A'),
-                        call['transcript']
-                    ])
-            except ValueError as e:
-                print(f"Error calculating duration for call {call['id']}: {str(e)}")
-    return filtered_calls
-
-# Function to update the Google Sheet with call data
-def update_google_sheet(service_account_file, spreadsheet_id, range_name, data):
+    return [
+        _call_row(call, phone_number, duration)
+        for call in calls
+        if 'startedAt' in call and 'endedAt' in call
+        and (duration := _call_duration(call)) is not None and duration > min_duration
+        and (phone_number := call.get('customer', _EMPTY).get('number', 'N/A')) not in EXCLUDE_PHONE_NUMBERS
+    ]
+
+# Request model for the Sheets API that serializes request bodies with orjson
+# The batchUpdate body holds every exported row, transcripts included, so encoding it
+# is the most expensive step before the upload and orjson is much faster than json.dumps
+class OrjsonModel(JsonModel):
+    def serialize(self, body_value):
+        return orjson.dumps(body_value)
+
+# Function to build the Google Sheets service
+# Cached so the service account file is only read, the credentials signed and the
+# discovery document loaded once per process, no matter how often the sheet is updated
+@lru_cache(maxsize=1)
+def get_sheets_service(service_account_file):
     SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
     creds = Credentials.from_service_account_file(service_account_file, scopes=SCOPES)
-    service = build('sheets', 'v4', credentials=creds)
+    return build('sheets', 'v4', credentials=creds, model=OrjsonModel())
 
-    sheet = service.spreadsheets()
-    result = sheet.values().update(
-        spreadsheetId=spreadsheet_id, range=range_name,
-        valueInputOption='USER_ENTERED', body={'values': data}).execute()
+# Function to update several ranges of the Google Sheet with call data in a single request
+# Takes a list of (range_name, values) pairs so all tabs are written with one batchUpdate,
+# which uses a single write request of quota
+def update_google_sheets_batch(service_account_file, spreadsheet_id, ranges_and_values):
+    sheet = get_sheets_service(service_account_file).spreadsheets()
+    # Sheets enforces a per-minute write quota, so rate limiting (429), server errors and
+    # dropped connections are retried with exponential backoff by the client library,
+    # which logs a warning for every retry
+    result = sheet.values().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body={
+            'valueInputOption': 'USER_ENTERED',
+            'data': [{'range': range_name, 'values': values} for range_name, values in ranges_and_values]
+        }).execute(num_retries=4)
 
     return result
 
-def update_pepfactor_outbound():
-    out_calls = fetch_call_logs(VAPI_URL, PEPFACTOR_OUT_ASSISTANT_ID, BEARER_TOKEN)
-    filtered_out_calls = filter_calls(out_calls)
-    RANGE_NAME = 'pepfactor_outbound!A1:H'  # Adjust if needed: {SheetName}!{Range}
-    values = [['ID', 'Phone Number', 'Duration (seconds)', 'Start Time', 'End Time', 'Summary', 'Success Evaluation', 'Transcript']] + filtered_out_calls
-    result = update_google_sheet(SERVICE_ACCOUNT_FILE, SPREADSHEET_ID, RANGE_NAME, values)
-    print(f"{result.get('updatedCells')} cells updated for PepFactor outbound calls.")
-
-def update_pepfactor_inbound():
-    in_calls = fetch_call_logs(VAPI_URL, PEPFACTOR_IN_ASSISTANT_ID, BEARER_TOKEN)
-    filtered_in_calls = filter_calls(in_calls)
-    RANGE_NAME = 'pepfactor_inbound!A1:H'
-    values = [['ID', 'Phone Number', 'Duration (seconds)', 'Start Time', 'End Time', 'Summary', 'Success Evaluation', 'Transcript']] + filtered_in_calls
-    result = update_google_sheet(SERVICE_ACCOUNT_FILE, SPREADSHEET_ID, RANGE_NAME, values)
-    print(f"{result.get('updatedCells')} cells updated for PepFactor inbound calls.")
-
-def update_greycorp_outbound():
-    calls = fetch_call_logs(VAPI_URL, GREYCORP_OUT_ASSISTANT_ID, BEARER_TOKEN)
-    filtered_calls = filter_calls(calls)
-    RANGE_NAME = 'greycorp_outbound!A1:H'
-    values = [['ID', 'Phone Number', 'Duration (seconds)', 'Start Time', 'End Time', 'Summary', 'Success Evaluation', 'Transcript']] + filtered_calls
-    result = update_google_sheet(SERVICE_ACCOUNT_FILE, SPREADSHEET_ID, RANGE_NAME, values)
-    print(f"{result.get('updatedCells')} cells updated for GreyCorp outbound calls.")
-
-def update_greycorp_inbound():
-    calls = fetch_call_logs(VAPI_URL, GREYCORP_IN_ASSISTANT_ID, BEARER_TOKEN)
-    filtered_calls = filter_calls(calls)
-    RANGE_NAME = 'greycorp_inbound!A1:H'
-    values = [['ID', 'Phone Number', 'Duration (seconds)', 'Start Time', 'End Time', 'Summary', 'Success Evaluation', 'Transcript']] + filtered_calls
-    result = update_google_sheet(SERVICE_ACCOUNT_FILE, SPREADSHEET_ID, RANGE_NAME, values)
-    print(f"{result.get('updatedCells')} cells updated for GreyCorp inbound calls.")
+# Function to fetch and filter the calls for one sheet
+# Returns the (range, values) pair to write, so main can upload every sheet in one batch
+def run_job(sheet_name, assistant_id):
+    settings = config()
+    values = filter_calls(chain.from_iterable(iter_call_pages(settings.vapi_url, assistant_id, settings.bearer_token)))
+    range_name = f'{sheet_name}!A1:H'  # Adjust if needed: {SheetName}!{Range}
+    # The filtered list isn't used anywhere else, so prepend the header in place
+    # rather than copying every row into a new list
+    values.insert(0, HEADER_ROW)
+    return range_name, values
 
 # Main function to fetch call logs, filter them, and update the Google Sheet
 def main(sheet_name=None):
+    settings = config()
     if sheet_name is None:
         # Update all sheets
-        update_pepfactor_outbound()
-        update_pepfactor_inbound()
-        update_greycorp_outbound()
-        update_greycorp_inbound()
-    elif sheet_name == "pepfactor_outbound":
-        update_pepfactor_outbound()
-    elif sheet_name == "pepfactor_inbound":
-        update_pepfactor_inbound()
-    elif sheet_name == "greycorp_outbound":
-        update_greycorp_outbound()
-    elif sheet_name == "greycorp_inbound":
-        update_greycorp_inbound()
+        jobs = list(settings.assistant_ids.items())
+    elif sheet_name in settings.assistant_ids:
+        jobs = [(sheet_name, settings.assistant_ids[sheet_name])]
     else:
         print("Invalid sheet name")
         return
 
+    # Without an assistant ID the Vapi API returns the calls of every assistant,
+    # so refuse to export a sheet whose assistant isn't configured
+    env_vars = dict(JOBS)
+    missing = [env_vars[name] for name, assistant_id in jobs if not assistant_id]
+    if missing:
+        raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
+
+    # Each sheet is independent and the work is dominated by waiting on the Vapi API,
+    # so run them concurrently to overlap the pagination requests of all assistants
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = [executor.submit(run_job, *job) for job in jobs]
+        ranges_and_values = [future.result() for future in futures]
+
+    result = update_google_sheets_batch(settings.service_account_file, settings.spreadsheet_id, ranges_and_values)
+    for response in result.get('responses', []):
+        print(f"{response.get('updatedCells')} cells updated in {response.get('updatedRange')}.")
+
 if __name__ == "__main__":
     if len(sys.argv) > 2:
         print("Usage: python main.py <SheetName>")